@@ -1,17 +1,25 @@
 """Prototype crypto proxy module, that demonstrates accepting a POST of chunked data
 from a client to a Tornado server (via ChunkedHandler), which uses a state machine
 (in ChunkFromClientStateMachine) to manage the receipt of the chunked data. Each input
-chunk is encrypted (via SampleCryptoProcessor's encrypt_block() method) and then stored
-in a buffer (managed via BufferManager). Another state machine (ChunkToTargetStateMachine)
+chunk is encrypted (via a crypto processor, chosen at startup by ProcessorFactory as the
+fastest allowed one on this machine, though only SampleCryptoProcessor exists so far) and
+then stored in a buffer (managed via BufferManager). Another state machine (ChunkToTargetStateMachine)
 manages sending/chunking the data to the target server, and draining the contents of
 the buffer.
 
 The input chunk size, the internal crypto block size (16 bytes by default), and the
-output chunk sizes (4k by default) are all isolated and managed independently of
-each other.
+output chunk sizes are all isolated and managed independently of each other. Output
+chunks start at 4k, and are grown or shrunk per connection (via AdaptiveChunkSizer),
+within configured bounds, as the buffer's backlog and the target's socket allow.
+
+The client's response is gated on the target server's response: once the last chunk has
+been sent, the target's status, reason, a few other headers and body are relayed back to the
+client (via ResponseFromTargetStateMachine). The target's ETag is of the ciphertext, so the
+client is instead sent an ETag of the plaintext it POST-ed. Connection or protocol errors with
+the target are reported to the client as a 502. If the client disconnects mid-request, the
+target request is cancelled, closing its socket and dropping any buffered data.
 
 Caveats:
-- No attempt to handle http errors!
 - No attempt to throttle the in and out flows, so the buffer could become arbitrarily large!
 - Only POSTs from a client are supported, though several of the classes should be reusable
   for either GETs or POSTs.
@@ -20,21 +28,29 @@ Caveats:
   decrypted when data is pulled out via the 'read_xxxx()' methods.
 """
 
+# Only import what the POST path needs, to keep startup fast: HTTP client backends (and
+#   pycurl, via curl_httpclient) should be imported where first used, not here.
 from tornado import (
     httpserver,
-    httpclient,
     ioloop,
     iostream,
+    httputil,
     options,
     web,
-    curl_httpclient
 )
 from tornado.options import options as options_data
+import hashlib
 import socket
+import sys
+import time
 
 
 #TODO(jwood) Consider adding a base Processor class, that this one extends?
 class SampleCryptoProcessor(object):
+    # Name used to select this processor, and CPU flags (per /proc/cpuinfo) it needs.
+    name = 'sample'
+    required_cpu_flags = ()
+
     def __init__(self, is_encrypt, block_size_bytes=16):
         self.block_size_bytes = block_size_bytes
         self.buffer = str()
@@ -70,6 +86,109 @@ class SampleCryptoProcessor(object):
         return block.lower()
 
 
+# Processor classes the ProcessorFactory may choose from, as real cipher
+#   implementations (AES-NI, VAES or pure software backed) become available.
+PROCESSOR_CANDIDATES = (
+    SampleCryptoProcessor,
+)
+
+
+# CPU feature flags that crypto processor implementations may make use of.
+CPU_CRYPTO_FLAGS = ('aes', 'vaes', 'avx2', 'avx512f')
+
+
+def probe_cpu_flags():
+    """Return the set of CPU feature flags (such as 'aes' or 'vaes') reported by the
+    processor, or an empty set if they can't be determined on this platform.
+    """
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('flags'):
+                    return set(line.split(':', 1)[1].split())
+    except (IOError, OSError):
+        pass
+    return set()
+
+
+class ProcessorFactory(object):
+    """Create crypto processors, using the fastest candidate available on this machine.
+
+    Call probe() once at startup (else the first create() does): candidates whose
+    required CPU flags are missing (or that aren't in 'allowed', if given) are skipped,
+    and the rest are micro-benchmarked for 'probe_seconds' each. The selection and its
+    measured throughput are then available via 'selected' and 'selected_gbps', and
+    reported by metrics() (served at /metrics).
+    """
+    def __init__(self, candidates=PROCESSOR_CANDIDATES, allowed=None,
+                 probe_seconds=0.005, probe_block_bytes=4096):
+        self.candidates = candidates
+        self.allowed = allowed
+        self.probe_seconds = probe_seconds
+        self.probe_block_bytes = probe_block_bytes
+
+        self.cpu_flags = set()
+        self.results = {}
+        self.selected = None
+        self.selected_gbps = None
+
+    def probe(self):
+        """Benchmark the usable candidates, and select the fastest of them."""
+        self.cpu_flags = probe_cpu_flags()
+        print('CPU crypto features: {0}'.format(
+            sorted(self.cpu_flags.intersection(CPU_CRYPTO_FLAGS)) or 'none'))
+
+        self.results = {}
+        for candidate in self.candidates:
+            if self.allowed and candidate.name not in self.allowed:
+                continue
+            if not self.cpu_flags.issuperset(candidate.required_cpu_flags):
+                print('...skipping processor {0}, needs {1}'.format(
+                    candidate.name, candidate.required_cpu_flags))
+                continue
+            self.results[candidate] = self._benchmark(candidate)
+            print('...processor {0}: {1:.3f} GB/s'.format(candidate.name,
+                                                          self.results[candidate]))
+
+        if not self.results:
+            raise ValueError("No usable crypto processor, allowed: {0}".format(self.allowed))
+
+        self.selected = max(self.results, key=self.results.get)
+        self.selected_gbps = self.results[self.selected]
+        print('Selected processor {0}: {1:.3f} GB/s'.format(self.selected.name,
+                                                           self.selected_gbps))
+
+    def create(self, is_encrypt):
+        """Return a new processor instance of the selected kind, probing if need be."""
+        if self.selected is None:
+            self.probe()
+        return self.selected(is_encrypt=is_encrypt)
+
+    def metrics(self):
+        """Return the processor selection and benchmark results, for metrics collection."""
+        return {
+            'processor': self.selected.name if self.selected else None,
+            'processor_gbps': self.selected_gbps,
+            'processor_candidates_gbps': dict((candidate.name, gbps) for candidate, gbps
+                                              in self.results.items()),
+            'cpu_crypto_flags': sorted(self.cpu_flags.intersection(CPU_CRYPTO_FLAGS)),
+        }
+
+    def _benchmark(self, candidate):
+        """Return the candidate's encrypt throughput in GB/s, over 'probe_seconds'."""
+        processor = candidate(is_encrypt=True)
+        block = b'x' * self.probe_block_bytes
+        processed = 0
+        start = time.time()
+        elapsed = 0.0
+        while elapsed < self.probe_seconds or not processed:
+            processor.process_data(block)
+            processed += len(block)
+            elapsed = time.time() - start
+        processor.finish()
+        return processed / (elapsed or 1e-9) / 1e9
+
+
 class BufferManager(object):
     def __init__(self, processor=None, max_buffer=4096):
         self.max_buffer = max_buffer
@@ -87,11 +206,11 @@ class BufferManager(object):
     def read_next_block(self):
         """Retrieve another 'max_buffer'-sized block of data from this buffer."""
         next_block = str()
-        print(">>>> Buffer before next read: '{0}'".format(self.buffer))
+        print(">>>> Buffer before next read: {0} bytes".format(len(self.buffer)))
         if len(self.buffer) >= self.max_buffer:
             next_block = self.buffer[:self.max_buffer]
             self.buffer = self.buffer[self.max_buffer:]
-        print(">>>> Buffer next block: '{0}'".format(next_block))
+        print(">>>> Buffer next block: {0} bytes".format(len(next_block)))
         return next_block
 
     def read_all(self):
@@ -103,33 +222,222 @@ class BufferManager(object):
 
         last_block = self.buffer
         self.buffer = str()
-        print(">>>> Buffer last block: '{0}'".format(last_block))
+        print(">>>> Buffer last block: {0} bytes".format(len(last_block)))
         return last_block
 
+    def clear(self):
+        """Discard all buffered data, without processing it."""
+        self.buffer = str()
+        if self.processor:
+            self.processor.buffer = str()
+
+
+class AdaptiveChunkSizer(object):
+    """Pick the size of the next chunk to send to a target server, per connection.
+
+    The size doubles (up to 'max_chunk') while the buffer holds a backlog of at least two
+    chunks, unless the target is the bottleneck: its socket is mostly blocking our writes,
+    per a running average of the fraction of each write left queued in the stream. Bigger
+    chunks wouldn't help then, only hold more data in memory. The size halves (down to
+    'min_chunk') when the buffer holds less than half a chunk, so data for small or slowly
+    arriving objects isn't held back waiting for a large chunk to fill.
+    """
+    def __init__(self, min_chunk=4096, max_chunk=1048576, initial_chunk=4096,
+                 blocked_threshold=0.5, blocked_weight=0.5):
+        if min_chunk < 1 or min_chunk > max_chunk:
+            raise ValueError("Chunk size bounds must satisfy 1 <= min <= max, got "
+                             "min={0} max={1}".format(min_chunk, max_chunk))
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.chunk_size = max(min_chunk, min(initial_chunk, max_chunk))
+        self.blocked_threshold = blocked_threshold
+        self.blocked_weight = blocked_weight
+
+        self.blocked = 0.0
+
+    def record_write(self, num_bytes, queued_bytes):
+        """Note that of a write of 'num_bytes' to the target, 'queued_bytes' were left
+        queued in the stream, as the target's socket wasn't accepting them.
+        """
+        fraction = min(queued_bytes / float(num_bytes), 1.0) if num_bytes else 0.0
+        self.blocked += self.blocked_weight * (fraction - self.blocked)
+
+    def next_chunk_size(self, buffered_bytes):
+        """Return the chunk size to use next, given 'buffered_bytes' waiting to be sent."""
+        is_blocked = self.blocked > self.blocked_threshold
+        if buffered_bytes >= 2 * self.chunk_size and not is_blocked:
+            self.chunk_size = min(self.chunk_size * 2, self.max_chunk)
+        elif buffered_bytes < self.chunk_size // 2:
+            self.chunk_size = max(self.chunk_size // 2, self.min_chunk)
+        return self.chunk_size
+
+
+# Headers from the target server's response that are relayed back to the client. The
+#   target's ETag isn't, as it is of the ciphertext (see TargetResponse.etag).
+TARGET_RESPONSE_HEADERS = (
+    'Content-Type',
+    'Last-Modified',
+    'Location',
+    'X-Timestamp',
+    'X-Trans-Id',
+)
+
+
+class TargetResponse(object):
+    """The final (non-1xx) response received from a target server.
+
+    'etag' is the ETag to send to the client: the MD5 of the plaintext the client
+    POST-ed, set once all of it has been received, or else None.
+    """
+    def __init__(self, code, reason, headers, body):
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.etag = None
+
+
+class ResponseFromTargetStateMachine(object):
+    """Handle reading the response to our chunked POST back from a target server.
+
+    Interim 1xx responses (such as the target's '100 Continue') are skipped. The final
+    response's body is read per its Content-Length, chunked transfer encoding, or else
+    until the target closes the connection.
+    """
+    def __init__(self, stream, callback_on_response, callback_on_error):
+        self.stream = stream
+        self.callback_on_response = callback_on_response
+        self.callback_on_error = callback_on_error
+
+        self.code = None
+        self.reason = None
+        self.headers = None
+        self.body = []
+
+        # Start response process state machine.
+        self._state_enter_look_for_headers()
+
+    def _state_enter_look_for_headers(self):
+        """Look for the status line and headers, calling back to _state_xxxx() when found."""
+        self._read(self.stream.read_until, b'\r\n\r\n', self._state_callback_look_for_headers)
+
+    def _state_enter_look_for_length(self):
+        """Look for a body chunk's length, calling back to _state_xxxx() when found."""
+        self._read(self.stream.read_until, b'\r\n', self._state_callback_look_for_length)
+
+    def _state_enter_process_data(self, chunk_length):
+        """Pull in a body chunk's data, calling back to _state_xxxx() when done."""
+        self._read(self.stream.read_bytes, chunk_length + 2, self._state_callback_process_data)
+
+    def _state_enter_look_for_trailers(self):
+        """Skip any trailers after the last body chunk, up to the closing empty line."""
+        self._read(self.stream.read_until, b'\r\n', self._state_callback_look_for_trailers)
+
+    def _read(self, read_method, *args):
+        """Start a read on the target stream, reporting an error if it's already closed."""
+        try:
+            read_method(*args)
+        except iostream.StreamClosedError as e:
+            self.callback_on_error(e)
+
+    def _state_enter_done(self):
+        self.callback_on_response(TargetResponse(self.code, self.reason,
+                                                 self.headers, b''.join(self.body)))
+
+    def _state_callback_look_for_headers(self, data):
+        """We now have the response status line and headers, setup to read the body."""
+        print('target-state-callback:look_for_headers(): {0}'.format(data))
+
+        status_line, _, header_lines = data.partition(b'\r\n')
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith(b'HTTP/') or not parts[1].isdigit():
+            self.callback_on_error(ValueError("Malformed target status line: "
+                                              "'{0}'".format(status_line)))
+            return
+
+        code = int(parts[1])
+        if 100 <= code < 200:
+            # Interim response, so the final response is still to come.
+            self._state_enter_look_for_headers()
+            return
+
+        self.code = code
+        self.reason = parts[2] if len(parts) > 2 else None
+        self.headers = httputil.HTTPHeaders.parse(header_lines)
+
+        if code in (204, 304):
+            self._state_enter_done()
+        elif self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            self._state_enter_look_for_length()
+        elif 'Content-Length' in self.headers:
+            content_length = int(self.headers['Content-Length'])
+            if content_length:
+                self._read(self.stream.read_bytes, content_length,
+                           self._state_callback_read_body)
+            else:
+                self._state_enter_done()
+        else:
+            self._read(self.stream.read_until_close, self._state_callback_read_body)
+
+    def _state_callback_read_body(self, data):
+        """We now have the entire (non-chunked) response body."""
+        self.body.append(data)
+        self._state_enter_done()
+
+    def _state_callback_look_for_length(self, data):
+        """We now have length of the (to follow) body chunk, setup to read it in."""
+        chunk_length = int(data[:-2].split(b';')[0], 16)
+        if chunk_length:
+            self._state_enter_process_data(chunk_length)
+        else:
+            self._state_enter_look_for_trailers()
+
+    def _state_callback_process_data(self, data):
+        """Store the body chunk we just received, then look for the next one."""
+        assert data[-2:] == b'\r\n', "chunk data ends with CRLF"
+        self.body.append(data[:-2])
+        self._state_enter_look_for_length()
+
+    def _state_callback_look_for_trailers(self, data):
+        if data == b'\r\n':
+            self._state_enter_done()
+        else:
+            self._state_enter_look_for_trailers()
+
 
 class ChunkToTargetStateMachine(object):
-    """Handle chunking POST data to a target server (Swift for example)."""
-    def __init__(self, callback_on_error):
+    """Handle chunking POST data to a target server (Swift for example).
+
+    Exactly one of 'callback_on_response' (with a TargetResponse) or 'callback_on_error'
+    is invoked, unless this machine is cancelled first.
+    """
+    def __init__(self, target, processor_factory, chunk_size_bounds, callback_on_response,
+                 callback_on_error):
+        self.callback_on_response = callback_on_response
         self.callback_on_error = callback_on_error
+        self.is_done = False
 
         #TODO(jwood) Get host/port info from http request itself, if using http proxy conventions
         #   that specify the entire target URL?
-        self.host = b'localhost'
-        self.port = 8080
+        self.host, self.port = target
         self.url = b"{0}:{1}".format(self.host, self.port)
         self.path = b'/chunked'
 
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         self.stream = iostream.IOStream(s)
+        self.stream.set_close_callback(self._handle_stream_closed)
         self.stream.connect((self.host, self.port), self._state_stream_is_idle)
 
-        self.buffer_mgr = BufferManager(processor=SampleCryptoProcessor(is_encrypt=True))
+        self.buffer_mgr = BufferManager(processor=processor_factory.create(is_encrypt=True))
+        self.chunk_sizer = AdaptiveChunkSizer(*chunk_size_bounds)
         self.stream_is_ready = False
         self.stream_is_sent_first_chunk = False
         self.finish_is_needed = False
 
     def send_chunk_data(self, data):
         """Receive input chunk of 'data' to process and (eventually) send to target."""
+        if self.is_done:
+            return
         if data:
             self.buffer_mgr.receive_data(data)
         if self.stream_is_ready:
@@ -137,14 +445,27 @@ class ChunkToTargetStateMachine(object):
 
     def finish(self):
         """Indicate that we need to finish up processing."""
+        if self.is_done:
+            return
         self.finish_is_needed = True
         if self.stream_is_ready:
             self._state_stream_is_idle()
 
+    def cancel(self):
+        """Abandon the request to the target, freeing its socket and buffered data."""
+        if self.is_done:
+            return
+        print("!!!! Cancelling request to target")
+        self._state_done()
+
     def _state_stream_is_idle(self):
         """Indicate that we are entering an idle no-streaming-in-progress state."""
+        if self.is_done:
+            return
         self.stream_is_ready = True
 
+        self.buffer_mgr.max_buffer = self.chunk_sizer.next_chunk_size(
+            len(self.buffer_mgr.buffer))
         chunk = self.buffer_mgr.read_next_block()
         if not chunk and self.finish_is_needed:
             chunk = self.buffer_mgr.read_all()
@@ -167,64 +488,151 @@ class ChunkToTargetStateMachine(object):
                  b"\r\n")
             if chunk:
                 chunk_out = b'{0}\r\n{1}\r\n'.format(hex(len(chunk))[2:], chunk)
-                self.stream.write(b'{0}{1}'.format(header_out, chunk_out),
-                                  callback=self._state_stream_is_idle)
+                self._write(b'{0}{1}'.format(header_out, chunk_out))
             else:
-                self.stream.write(header_out,
-                                  callback=self._state_stream_is_idle)
+                self._write(header_out)
+            if self.is_done:
+                return
 
-            #TODO(jwood) Handle this response from target server, trap on errors for example.
-            self.stream.read_until_close(self._handle_read_closed)
+            ResponseFromTargetStateMachine(self.stream,
+                                           self._handle_response,
+                                           self._handle_error)
 
         # Else POST the next chunk to the target server.
         elif chunk:
-            self.stream.write(b'{0}\r\n{1}\r\n'.format(hex(len(chunk))[2:], chunk),
-                              callback=self._state_stream_is_idle)
+            self._write(b'{0}\r\n{1}\r\n'.format(hex(len(chunk))[2:], chunk))
 
         # Else, we've sent all the data and the 'finish' state is called for, so
         #   output the closing 0-length chunk to end the long-running post.
         elif self.finish_is_needed:
-            self.stream.write(b'0\r\n\r\n',
-                              callback=self._state_finished)
+            self._write_stream(b'0\r\n\r\n', self._state_finished)
         else:
             self.stream_is_ready = True
 
-    def _handle_read_closed(self, response):
-        #TODO(jwood) Handle error response from target server!
-        print("Target response: {0}".format(response))
+    def _write(self, data):
+        """Write 'data' to the target, telling the chunk sizer how much of it the target's
+        socket couldn't take straight away.
+        """
+        self._write_stream(data, self._state_stream_is_idle)
+        if not self.is_done:
+            # write() sends as much as the socket will take before returning, so if it's
+            #   still writing, the target's socket is blocking us.
+            queued_bytes = len(data) if self.stream.writing() else 0
+            self.chunk_sizer.record_write(len(data), queued_bytes)
+
+    def _write_stream(self, data, callback):
+        """Write 'data' to the target, reporting an error if the target has gone away.
+
+        The stream may already be closed (by a target reset, say) while its close callback
+        is still queued, in which case write() raises rather than calling back.
+        """
+        try:
+            self.stream.write(data, callback=callback)
+        except iostream.StreamClosedError as e:
+            self._handle_error(self.stream.error or e)
+
+    def _handle_response(self, response):
+        """The target's final response is in, even if we haven't sent all our data."""
+        print("Target response: {0} {1}".format(response.code, response.reason))
+        if self.is_done:
+            return
+        self._state_done()
+        self.callback_on_response(response)
+
+    def _handle_error(self, error):
+        print("Target error: {0}".format(error))
+        if self.is_done:
+            return
+        self._state_done()
+        self.callback_on_error(error)
+
+    def _handle_stream_closed(self):
+        """The target connection closed before we got its full response."""
+        error = self.stream.error or IOError("Target closed connection")
+        self._handle_error(error)
 
     def _state_finished(self):
         print("!!!! Finished sending to target")
 
+    def _state_done(self):
+        """Release the target connection and any buffered data, we're done with them."""
+        self.is_done = True
+        self.stream.set_close_callback(None)
+        self.stream.close()
+        self.buffer_mgr.clear()
+
 
 #TODO(jwood): Could maybe add thread sleeps in here if the to-target state machine gets behind (so if
 #  the buffer size gets too big).
 class ChunkFromClientStateMachine(object):
-    """Handle receiving chunked data POST-ed to our proxy server."""
-    def __init__(self, stream, callback_on_done, callback_on_error):
+    """Handle receiving chunked data POST-ed to our proxy server.
+
+    'callback_on_done' is invoked with the target server's TargetResponse, once it is in.
+    """
+    def __init__(self, stream, target, processor_factory, chunk_size_bounds,
+                 callback_on_done, callback_on_error):
         self.stream = stream
         self.callback_on_done = callback_on_done
         self.callback_on_error = callback_on_error
+        self.callback_on_drained = None
+        self.is_done = False
+        self.plaintext_md5 = hashlib.md5()
 
-        self.machine_to_target = ChunkToTargetStateMachine(callback_on_error)
+        self.machine_to_target = ChunkToTargetStateMachine(target,
+                                                           processor_factory,
+                                                           chunk_size_bounds,
+                                                           self._callback_on_response,
+                                                           callback_on_error)
 
         # Start request process state machine.
         self._state_enter_look_for_length()
 
     def _state_enter_look_for_length(self):
         """Look for the chunk's length, calling back to _state_xxxx() when found."""
-        self.stream.read_until(b'\r\n', self._state_callback_look_for_length)
+        self._read(self.stream.read_until, b'\r\n', self._state_callback_look_for_length)
 
     def _state_enter_process_data(self, chunk_length):
         """Pull in the chunk's data, calling back to _state_xxxx() when done."""
-        self.stream.read_bytes(chunk_length + 2, self._state_callback_process_data)
+        self._read(self.stream.read_bytes, chunk_length + 2, self._state_callback_process_data)
+
+    def _read(self, read_method, *args):
+        """Start a read on the client stream, cancelling if the client has gone away."""
+        try:
+            read_method(*args)
+        except iostream.StreamClosedError:
+            self.cancel()
 
     def _state_enter_done(self):
+        self.is_done = True
         self.machine_to_target.finish()
-        self.callback_on_done()
+        if self.callback_on_drained:
+            self.callback_on_drained()
+
+    def drain(self, callback):
+        """Read the rest of the client's chunks, calling back once the last one is in.
+
+        Once the target has responded there's nothing to send them to, so (as the target
+        machine is done) they are dropped.
+        """
+        self.callback_on_drained = callback
+        if self.is_done:
+            callback()
+
+    def cancel(self):
+        """The client went away, so abandon the request to the target."""
+        self.is_done = True
+        self.machine_to_target.cancel()
+
+    def _callback_on_response(self, response):
+        """Give the response an ETag of the plaintext, if we've received all of it."""
+        if self.is_done:
+            response.etag = self.plaintext_md5.hexdigest()
+        self.callback_on_done(response)
 
     def _state_callback_look_for_length(self, data):
         """We now have length of the (to follow) chunk of data, setup to read it in."""
+        if self.is_done:
+            return
         print('state-callback:look_for_length(): {0}'.format(data))
 
         assert data[-2:] == b'\r\n', "chunk size ends with CRLF"
@@ -240,6 +648,8 @@ class ChunkFromClientStateMachine(object):
 
     def _state_callback_process_data(self, data):
         """Process the chunk of data we just recieved."""
+        if self.is_done:
+            return
         print('state-callback:process_data()..."{0}"'.format(data))
 
         assert data[-2:] == b'\r\n', "chunk data ends with CRLF"
@@ -247,6 +657,7 @@ class ChunkFromClientStateMachine(object):
         print('...writing:"{0}"'.format(data[:-2]))
 
         # Give next set of data to the to-target state machine to manage.
+        self.plaintext_md5.update(data[:-2])
         self.machine_to_target.send_chunk_data(data[:-2])
 
         # Setup to process the next chunk of data.
@@ -270,9 +681,13 @@ class ChunkedHandler(web.RequestHandler):
             print('...got chunked...')
 
             self._auto_finish = False
-            ChunkFromClientStateMachine(self.request.connection.stream,
-                                        self._callback_on_done,
-                                        self._callback_on_error)
+            self.machine_from_client = ChunkFromClientStateMachine(
+                self.request.connection.stream,
+                self.settings['target'],
+                self.settings['processor_factory'],
+                self.settings['chunk_size_bounds'],
+                self._callback_on_done,
+                self._callback_on_error)
 
             self.request.write(b"HTTP/1.1 100 (Continue)\r\n\r\n")
         else:
@@ -281,27 +696,115 @@ class ChunkedHandler(web.RequestHandler):
     #TODO(jwood) Add GET method, and a chunk-to-client state machine and
     #  a chunk-from-target state machine.
 
-    def _callback_on_done(self):
-        """Indicates that we are done processing this request."""
-        print('finish()')
-        self.finish()
+    def on_connection_close(self):
+        """The client disconnected, so cancel the in-progress request to the target."""
+        print('on_connection_close()')
+        machine = getattr(self, 'machine_from_client', None)
+        if machine:
+            machine.cancel()
+
+    def _callback_on_done(self, response):
+        """Indicates that the target has responded, so relay its response to the client."""
+        print('finish(): {0}'.format(response.code))
+        if self._finished:
+            return
+        # Tornado only knows the reasons for standard codes, not (say) Swift's 499.
+        self.set_status(response.code,
+                        response.reason or httputil.responses.get(response.code, 'Unknown'))
+        for header in TARGET_RESPONSE_HEADERS:
+            value = response.headers.get(header)
+            if value:
+                self.set_header(header, value)
+        # Only stand in for an ETag the target gave, that is, for data it has stored.
+        if response.etag and 'ETag' in response.headers:
+            self.set_header('ETag', response.etag)
+        self._respond(response.body)
 
     def _callback_on_error(self, error):
-        """Handle errors gracefully here."""
-        print('error!()')
-        self.set_status(500)
-        # TODO(jwood) Causes write after finish exception: self.write('Internal server error:\n' + str(error))
-        # self.finish()
+        """Handle errors with the target by failing the client's request."""
+        print('error!(): {0}'.format(error))
+        if self._finished:
+            return
+        self.set_status(502)
+        self._respond('Bad gateway:\n' + str(error))
+
+    def _respond(self, body):
+        """Send our response, finishing once the client's whole request has been read.
+
+        The target may respond (or fail) before the client has sent all of its chunks.
+        Closing the connection with those unread would reset it, likely losing our
+        response, so the response is sent in full now, and the rest of the request is
+        read and dropped before finishing.
+        """
+        if self.get_status() not in (204, 304):
+            self.set_header('Content-Length', len(body))
+        if body:
+            self.write(body)
+        if self.machine_from_client.is_done:
+            self.finish()
+        else:
+            self.flush()
+            self.machine_from_client.drain(self._callback_on_drained)
 
+    def _callback_on_drained(self):
+        if not self._finished:
+            self.finish()
 
-if __name__ == '__main__':
+
+class MetricsHandler(web.RequestHandler):
+    """Report the proxy's metrics as JSON, for a metrics collector to poll."""
+    def get(self):
+        self.write(self.settings['processor_factory'].metrics())
+
+
+def make_application(processor_factory, chunk_size_bounds=(4096, 1048576),
+                     target=('localhost', 8080)):
+    """Return the proxy's Tornado application, using the (probed) 'processor_factory',
+    and sending chunks to the (host, port) 'target' of between the (min, max)
+    'chunk_size_bounds'.
+    """
+    return web.Application([
+        ('/chunked$', ChunkedHandler, ),
+        ('/metrics$', MetricsHandler, ),
+    ], processor_factory=processor_factory, chunk_size_bounds=chunk_size_bounds,
+       target=target)
+
+
+def main():
+    """Parse the command line (once), then start serving."""
     options.define("port", default=8000, help="run on the given port", type=int)
+    options.define("target_host", default='localhost', type=str,
+                   help="host of the target server to proxy to")
+    options.define("target_port", default=8080, type=int,
+                   help="port of the target server to proxy to")
+    options.define("processors", default=None, multiple=True, type=str,
+                   help="crypto processors allowed to be selected (default: any)")
+    options.define("min_chunk_size", default=4096, type=int,
+                   help="smallest chunk size, in bytes, to send to the target")
+    options.define("max_chunk_size", default=1048576, type=int,
+                   help="largest chunk size, in bytes, to send to the target")
     options.parse_command_line()
 
-    application = web.Application([
-        ('/chunked$', ChunkedHandler, ),
-    ])
-    http_server = httpserver.HTTPServer(application)
+    processor_factory = ProcessorFactory(allowed=options_data.processors)
+    try:
+        processor_factory.probe()
+    except ValueError as e:
+        sys.exit(str(e))
+
+    chunk_size_bounds = (options_data.min_chunk_size, options_data.max_chunk_size)
+    try:
+        # Check the bounds now, rather than on each client's first request.
+        AdaptiveChunkSizer(*chunk_size_bounds)
+    except ValueError as e:
+        sys.exit(str(e))
+    target = (options_data.target_host, options_data.target_port)
+    http_server = httpserver.HTTPServer(make_application(processor_factory,
+                                                         chunk_size_bounds,
+                                                         target))
     http_server.listen(options_data.port)
     print('Starting up server...')
     ioloop.IOLoop.instance().start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+# A stand-in Swift target server, for regression testing the crypto proxy's
+#   throughput, memory bounds and backpressure without a real cluster. Unlike
+#   main.py it reads chunked POSTs straight off a blocking socket, so the pace
+#   it reads at is the pace TCP pushes back on the proxy with:
+#
+#   -latency          seconds to wait before sending the final response
+#   -bandwidth        cap on bytes/second read from each connection (0 = none)
+#   -read_size        max bytes per recv(), with -read_delay seconds after each,
+#                     to mimic a slow reader
+#   -reset_after      abort the connection with a TCP reset once this many body
+#                     bytes have been read (0 = never)
+#   -status           final response status, to exercise error propagation
+#   -rcvbuf           socket receive buffer size, so backpressure kicks in early
+#
+# Each request's stats (bytes, chunk sizes, elapsed time, throughput) are printed
+#   once it completes.
+
+import hashlib
+import socket
+import SocketServer
+import struct
+import time
+
+from tornado.options import define, options, parse_command_line
+
+
+define('port', default=8080)
+define('latency', default=0.0)
+define('bandwidth', default=0)
+define('read_size', default=65536)
+define('read_delay', default=0.0)
+define('reset_after', default=0)
+define('status', default=201)
+define('rcvbuf', default=0)
+
+
+class ConnectionReset(Exception):
+    """Raised to abandon a request once -reset_after body bytes are read."""
+
+
+class PacedReader(object):
+    """Read from a socket, no faster than the configured bandwidth and read pace."""
+    def __init__(self, sock, bandwidth=0, read_size=65536, read_delay=0.0):
+        self.sock = sock
+        self.bandwidth = bandwidth
+        self.read_size = read_size
+        self.read_delay = read_delay
+
+        self.buffer = str()
+        self.bytes_read = 0
+        self.start = time.time()
+
+    def read_line(self):
+        """Return the next CRLF terminated line, including the CRLF."""
+        while b'\r\n' not in self.buffer:
+            self._fill()
+        line, _, self.buffer = self.buffer.partition(b'\r\n')
+        return line + b'\r\n'
+
+    def read_bytes(self, num_bytes):
+        """Return exactly 'num_bytes' bytes."""
+        while len(self.buffer) < num_bytes:
+            self._fill()
+        data = self.buffer[:num_bytes]
+        self.buffer = self.buffer[num_bytes:]
+        return data
+
+    def _fill(self):
+        data = self.sock.recv(self.read_size)
+        if not data:
+            raise EOFError("Connection closed by client")
+        self.buffer = ''.join([self.buffer, data])
+        self.bytes_read += len(data)
+
+        if self.read_delay:
+            time.sleep(self.read_delay)
+        if self.bandwidth:
+            # Sleep until our average rate is back under the cap.
+            ahead = self.bytes_read / float(self.bandwidth) - (time.time() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+class FakeTargetHandler(SocketServer.BaseRequestHandler):
+    """Handle one connection's chunked POST, per the module's options."""
+    def handle(self):
+        reader = PacedReader(self.request, options.bandwidth,
+                             options.read_size, options.read_delay)
+        start = time.time()
+        chunk_sizes = []
+        body_md5 = hashlib.md5()
+
+        try:
+            headers = self._read_headers(reader)
+            if headers.get('expect') == '100-continue':
+                self.request.sendall(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+            while True:
+                chunk_length = int(reader.read_line()[:-2].split(b';')[0], 16)
+                if not chunk_length:
+                    break
+                chunk = reader.read_bytes(chunk_length + 2)
+                assert chunk[-2:] == b'\r\n', "chunk data ends with CRLF"
+                chunk_sizes.append(chunk_length)
+                body_md5.update(chunk[:-2])
+                if options.reset_after and sum(chunk_sizes) >= options.reset_after:
+                    raise ConnectionReset()
+            while reader.read_line() != b'\r\n':
+                pass  # Skip trailers.
+        except ConnectionReset:
+            self._reset()
+            self._report('RESET', start, chunk_sizes)
+            return
+        except (EOFError, socket.error) as e:
+            self._report('ABORTED ({0})'.format(e), start, chunk_sizes)
+            return
+
+        if options.latency:
+            time.sleep(options.latency)
+        self.request.sendall(b'HTTP/1.1 {0} Fake\r\n'
+                             b'ETag: {1}\r\n'
+                             b'Content-Length: 0\r\n'
+                             b'Connection: close\r\n\r\n'.format(options.status,
+                                                                 body_md5.hexdigest()))
+        self._report(options.status, start, chunk_sizes)
+
+    def _read_headers(self, reader):
+        headers = {}
+        reader.read_line()  # Request line.
+        while True:
+            line = reader.read_line()
+            if line == b'\r\n':
+                return headers
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+
+    def _reset(self):
+        """Close the connection with a TCP reset, rather than a graceful FIN."""
+        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                struct.pack('ii', 1, 0))
+        self.request.close()
+
+    def _report(self, outcome, start, chunk_sizes):
+        elapsed = time.time() - start
+        total = sum(chunk_sizes)
+        print('{0}: {1} bytes in {2} chunks (min={3} max={4}) in {5:.3f}s, '
+              '{6:.1f} MB/s'.format(outcome, total, len(chunk_sizes),
+                                   min(chunk_sizes or [0]), max(chunk_sizes or [0]),
+                                   elapsed, total / (elapsed or 1e-9) / 1e6))
+
+
+class FakeTargetServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def server_bind(self):
+        # Accepted sockets inherit the listening socket's receive buffer size.
+        if options.rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, options.rcvbuf)
+        SocketServer.ThreadingTCPServer.server_bind(self)
+
+
+if __name__ == '__main__':
+    parse_command_line()
+    server = FakeTargetServer(('localhost', options.port), FakeTargetHandler)
+    print('Starting up fake target...')
+    server.serve_forever()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# Measures the crypto proxy's startup cost: the import time of each module it
+#   loads, and the time from launching it to its first accepted connection.
+
+import json
+import socket
+import subprocess
+import sys
+import time
+
+from tornado.options import define, options, parse_command_line
+
+
+define('port', default=8000)
+define('runs', default=5)
+define('timeout', default=10.0)
+
+# Run in a fresh interpreter: imports crypto_proxy with a sys.meta_path finder that times
+#   every module it loads, directly or not (submodules loaded via a 'from package import
+#   module' fromlist don't go through __import__, but do go through sys.meta_path), and
+#   prints a JSON list of [module, self seconds, cumulative seconds] in load order. Self
+#   time excludes the time spent importing the module's own dependencies.
+IMPORT_PROFILER = '''
+import imp, importlib, json, sys, time
+
+class TimingFinder(object):
+    def __init__(self):
+        self.loading = set()
+        self.stack = []
+        self.times = []
+
+    def find_module(self, fullname, path=None):
+        if fullname in self.loading:
+            return None
+        # Only claim modules that exist, so that failed imports (such as Python 2
+        #   trying relative imports first) behave as usual.
+        try:
+            found = imp.find_module(fullname.rpartition('.')[2], path)
+        except ImportError:
+            return None
+        if found[0]:
+            found[0].close()
+        return self
+
+    def load_module(self, fullname):
+        # Time the usual import machinery loading the module, with this finder
+        #   standing aside for it.
+        self.loading.add(fullname)
+        self.stack.append(0.0)
+        start = time.time()
+        try:
+            return importlib.import_module(fullname)
+        finally:
+            elapsed = time.time() - start
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            self.loading.discard(fullname)
+            if fullname in sys.modules:
+                self.times.append((fullname, elapsed - children, elapsed))
+
+finder = TimingFinder()
+sys.meta_path.insert(0, finder)
+import crypto_proxy
+sys.meta_path.remove(finder)
+print(json.dumps(finder.times))
+'''
+
+
+def profile_imports():
+    """Return [module, self seconds, cumulative seconds] for each module crypto_proxy
+    loads, in load order, from a fresh interpreter.
+    """
+    return json.loads(subprocess.check_output([sys.executable, '-c', IMPORT_PROFILER]))
+
+
+def port_is_free(port):
+    """Return True if nothing is accepting connections on 'port'."""
+    try:
+        socket.create_connection(('localhost', port), timeout=0.1).close()
+    except socket.error:
+        return True
+    return False
+
+
+def time_first_connection(port, timeout):
+    """Launch the proxy, returning the seconds until it accepts a connection."""
+    if not port_is_free(port):
+        raise RuntimeError("Port {0} is already in use".format(port))
+
+    start = time.time()
+    proxy = subprocess.Popen([sys.executable, 'crypto_proxy.py', '-port={0}'.format(port)],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        while time.time() - start < timeout:
+            if proxy.poll() is not None:
+                raise RuntimeError("Proxy exited early: {0}".format(proxy.stdout.read()))
+            try:
+                socket.create_connection(('localhost', port), timeout=0.1).close()
+            except socket.error:
+                time.sleep(0.001)
+                continue
+            elapsed = time.time() - start
+            if proxy.poll() is not None:
+                raise RuntimeError("Proxy exited after accepting a connection: "
+                                   "{0}".format(proxy.stdout.read()))
+            return elapsed
+        raise RuntimeError("Proxy didn't accept a connection in {0}s".format(timeout))
+    finally:
+        if proxy.poll() is None:
+            proxy.kill()
+        proxy.wait()
+
+
+def main():
+    parse_command_line()
+
+    # Keep each module's best self and cumulative times over the runs.
+    best = {}
+    order = []
+    for _ in range(options.runs):
+        for module, self_time, cumulative in profile_imports():
+            if module not in best:
+                order.append(module)
+                best[module] = (self_time, cumulative)
+            else:
+                best[module] = (min(best[module][0], self_time),
+                                min(best[module][1], cumulative))
+
+    print('Import time per module, in load order (seconds, best of {0}):'.format(options.runs))
+    print('  {0:<32} {1:>8} {2:>11}'.format('module', 'self', 'cumulative'))
+    for module in order:
+        print('  {0:<32} {1:8.4f} {2:11.4f}'.format(module, *best[module]))
+
+    times = [time_first_connection(options.port, options.timeout)
+             for _ in range(options.runs)]
+    print('Time to first accepted connection (seconds): '
+          'best={0:.4f} worst={1:.4f}'.format(min(times), max(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+import hashlib
+import random
+import socket
+import struct
+import time
+import unittest
+
+from tornado import iostream, tcpserver
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, bind_unused_port
+
+import crypto_proxy
+from crypto_proxy import (
+    AdaptiveChunkSizer,
+    ProcessorFactory,
+    ResponseFromTargetStateMachine,
+    make_application,
+)
+
+
+class AdaptiveChunkSizerTestCase(unittest.TestCase):
+
+    def _send(self, sizer, backlog, blocked_odds, steps, incoming=524288,
+              queued_range=(0.3, 1.0), seed=42):
+        """Simulate 'steps' writes to a target, with 'incoming' bytes arriving from the
+        client per write, and 'blocked_odds' of a write having a 'queued_range' fraction
+        of it left queued. Return the chunk sizes used.
+        """
+        rand = random.Random(seed)
+        sizes = []
+        for _ in range(steps):
+            backlog += incoming
+            chunk_size = sizer.next_chunk_size(backlog)
+            sizes.append(chunk_size)
+            sent = min(chunk_size, backlog)
+            backlog -= sent
+            queued = 0
+            if rand.random() < blocked_odds:
+                queued = int(sent * rand.uniform(*queued_range))
+            sizer.record_write(sent, queued)
+        return sizes
+
+    def test_grows_with_backlog_despite_noisy_writes(self):
+        sizer = AdaptiveChunkSizer(4096, 1048576)
+        sizes = self._send(sizer, backlog=400000, blocked_odds=0.2, steps=40)
+
+        self.assertEqual(1048576, sizes[-1])
+        self.assertTrue(sizes.index(1048576) < 10)
+        # Occasional blocked writes never shrink the chunk while there's a backlog.
+        self.assertEqual(sorted(sizes), sizes)
+
+    def test_holds_when_target_is_blocking(self):
+        sizer = AdaptiveChunkSizer(4096, 1048576)
+        sizes = self._send(sizer, backlog=400000, blocked_odds=1.0, steps=40,
+                           queued_range=(0.6, 1.0))
+
+        self.assertTrue(max(sizes) < 1048576)
+        self.assertEqual(sizes[-1], sizes[-10])
+
+    def test_shrinks_to_min_when_starved(self):
+        sizer = AdaptiveChunkSizer(4096, 1048576, initial_chunk=1048576)
+        sizes = [sizer.next_chunk_size(100) for _ in range(20)]
+
+        self.assertEqual(4096, sizes[-1])
+        self.assertEqual(4096, min(sizes))
+
+    def test_initial_chunk_is_clamped(self):
+        self.assertEqual(8192, AdaptiveChunkSizer(8192, 65536).chunk_size)
+        self.assertEqual(65536, AdaptiveChunkSizer(4096, 65536,
+                                                   initial_chunk=1048576).chunk_size)
+
+    def test_record_empty_write(self):
+        sizer = AdaptiveChunkSizer()
+        sizer.record_write(0, 0)
+        self.assertEqual(0.0, sizer.blocked)
+
+    def test_rejects_bad_bounds(self):
+        self.assertRaises(ValueError, AdaptiveChunkSizer, 0, 4096)
+        self.assertRaises(ValueError, AdaptiveChunkSizer, 8192, 4096)
+
+
+class FakeProcessor(object):
+    """A processor candidate that spends 'delay' seconds on each block."""
+    name = 'fake'
+    required_cpu_flags = ()
+    delay = 0.0
+
+    def __init__(self, is_encrypt):
+        self.is_encrypt = is_encrypt
+
+    def process_data(self, data):
+        time.sleep(self.delay)
+        return data
+
+    def finish(self):
+        return b''
+
+
+class FastProcessor(FakeProcessor):
+    name = 'fast'
+
+
+class SlowProcessor(FakeProcessor):
+    name = 'slow'
+    delay = 0.001
+
+
+class VaesProcessor(FakeProcessor):
+    name = 'vaes'
+    required_cpu_flags = ('vaes',)
+
+
+class ProcessorFactoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.probe_cpu_flags = crypto_proxy.probe_cpu_flags
+        crypto_proxy.probe_cpu_flags = lambda: set(['aes', 'sse2'])
+
+    def tearDown(self):
+        crypto_proxy.probe_cpu_flags = self.probe_cpu_flags
+
+    def test_selects_fastest(self):
+        factory = ProcessorFactory(candidates=(SlowProcessor, FastProcessor))
+        factory.probe()
+
+        self.assertEqual(FastProcessor, factory.selected)
+        self.assertTrue(factory.selected_gbps > factory.results[SlowProcessor])
+
+    def test_skips_missing_cpu_flags(self):
+        factory = ProcessorFactory(candidates=(VaesProcessor, SlowProcessor))
+        factory.probe()
+
+        self.assertEqual(SlowProcessor, factory.selected)
+        self.assertFalse(VaesProcessor in factory.results)
+
+    def test_skips_not_allowed(self):
+        factory = ProcessorFactory(candidates=(SlowProcessor, FastProcessor),
+                                   allowed=['slow'])
+        factory.probe()
+
+        self.assertEqual(SlowProcessor, factory.selected)
+        self.assertEqual([SlowProcessor], list(factory.results))
+
+    def test_no_usable_candidate(self):
+        factory = ProcessorFactory(candidates=(VaesProcessor,), allowed=['vaes'])
+        self.assertRaises(ValueError, factory.probe)
+
+    def test_create_probes_lazily(self):
+        factory = ProcessorFactory(candidates=(SlowProcessor, FastProcessor),
+                                   allowed=['slow'])
+        processor = factory.create(is_encrypt=True)
+
+        self.assertTrue(isinstance(processor, SlowProcessor))
+        self.assertTrue(processor.is_encrypt)
+        self.assertEqual(SlowProcessor, factory.selected)
+
+    def test_metrics(self):
+        factory = ProcessorFactory(candidates=(SlowProcessor, FastProcessor))
+        self.assertEqual(None, factory.metrics()['processor'])
+
+        factory.probe()
+        metrics = factory.metrics()
+        self.assertEqual('fast', metrics['processor'])
+        self.assertEqual(factory.selected_gbps, metrics['processor_gbps'])
+        self.assertEqual(set(['slow', 'fast']), set(metrics['processor_candidates_gbps']))
+        self.assertEqual(['aes'], metrics['cpu_crypto_flags'])
+
+
+def decode_chunked(data):
+    """Return the body of chunked transfer encoded 'data', up to its last chunk."""
+    body = []
+    while True:
+        length_line, _, data = data.partition(b'\r\n')
+        length = int(length_line, 16)
+        if not length:
+            return b''.join(body)
+        body.append(data[:length])
+        data = data[length + 2:]
+
+
+class ResponseFromTargetStateMachineTestCase(AsyncTestCase):
+
+    def _read_response(self, data, close=False):
+        """Have the machine read the target's response 'data', returning either
+        ('response', TargetResponse) or ('error', exception).
+        """
+        ours, theirs = socket.socketpair()
+        stream = iostream.IOStream(ours, io_loop=self.io_loop)
+        theirs.sendall(data)
+        if close:
+            theirs.close()
+        ResponseFromTargetStateMachine(stream,
+                                       lambda response: self.stop(('response', response)),
+                                       lambda error: self.stop(('error', error)))
+        result = self.wait()
+        stream.close()
+        theirs.close()
+        return result
+
+    def test_content_length(self):
+        kind, response = self._read_response(b'HTTP/1.1 201 Created\r\n'
+                                              b'ETag: abc\r\n'
+                                              b'Content-Length: 5\r\n\r\nhello')
+        self.assertEqual('response', kind)
+        self.assertEqual(201, response.code)
+        self.assertEqual('Created', response.reason)
+        self.assertEqual('abc', response.headers['ETag'])
+        self.assertEqual(b'hello', response.body)
+
+    def test_skips_interim_responses(self):
+        kind, response = self._read_response(b'HTTP/1.1 100 Continue\r\n\r\n'
+                                              b'HTTP/1.1 100 (Continue)\r\n\r\n'
+                                              b'HTTP/1.1 200 OK\r\n'
+                                              b'Content-Length: 0\r\n\r\n')
+        self.assertEqual('response', kind)
+        self.assertEqual(200, response.code)
+        self.assertEqual(b'', response.body)
+
+    def test_chunked_with_trailers(self):
+        kind, response = self._read_response(b'HTTP/1.1 200 OK\r\n'
+                                              b'Transfer-Encoding: chunked\r\n\r\n'
+                                              b'5;ext=1\r\nhello\r\n'
+                                              b'6\r\n world\r\n'
+                                              b'0\r\n'
+                                              b'X-Trailer: yes\r\n\r\n')
+        self.assertEqual('response', kind)
+        self.assertEqual(b'hello world', response.body)
+
+    def test_read_until_close(self):
+        kind, response = self._read_response(b'HTTP/1.0 200 OK\r\n\r\nhello',
+                                              close=True)
+        self.assertEqual('response', kind)
+        self.assertEqual(b'hello', response.body)
+
+    def test_no_body_for_204(self):
+        kind, response = self._read_response(b'HTTP/1.1 204 No Content\r\n\r\n')
+        self.assertEqual('response', kind)
+        self.assertEqual(204, response.code)
+
+    def test_no_reason(self):
+        kind, response = self._read_response(b'HTTP/1.1 499\r\n'
+                                              b'Content-Length: 0\r\n\r\n')
+        self.assertEqual(499, response.code)
+        self.assertEqual(None, response.reason)
+
+    def test_malformed_status_line(self):
+        kind, error = self._read_response(b'HTTP/1.1 OK 200\r\n\r\n')
+        self.assertEqual('error', kind)
+        self.assertTrue(isinstance(error, ValueError))
+
+
+class ScriptedTarget(tcpserver.TCPServer):
+    """A target server, that reads a request's headers then hands its stream to
+    'on_request(stream)' to script the rest.
+    """
+    on_request = None
+
+    def handle_stream(self, stream, address):
+        stream.read_until(b'\r\n\r\n', lambda headers: self.on_request(stream))
+
+
+class ChunkedHandlerTestCase(AsyncHTTPTestCase):
+
+    def setUp(self):
+        sock, self.target_port = bind_unused_port()
+        super(ChunkedHandlerTestCase, self).setUp()
+        self.target = ScriptedTarget(io_loop=self.io_loop)
+        self.target.add_sockets([sock])
+        self.target_body = None
+
+    def tearDown(self):
+        self.target.stop()
+        super(ChunkedHandlerTestCase, self).tearDown()
+
+    def get_app(self):
+        return make_application(ProcessorFactory(), target=('localhost', self.target_port))
+
+    def _store(self, response):
+        """Script the target to store the whole body, then send 'response'."""
+        def on_request(stream):
+            stream.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            stream.read_until(b'0\r\n\r\n', lambda data: on_body(stream, data))
+
+        def on_body(stream, data):
+            self.target_body = decode_chunked(data)
+            stream.write(response.format(etag=hashlib.md5(self.target_body).hexdigest()))
+        self.target.on_request = on_request
+
+    def _connect(self):
+        stream = iostream.IOStream(socket.socket(), io_loop=self.io_loop)
+        stream.connect(('localhost', self.get_http_port()), self.stop)
+        self.wait()
+        stream.write(b'POST /chunked HTTP/1.1\r\nHost: localhost\r\n'
+                     b'Transfer-Encoding: chunked\r\n'
+                     b'Expect: 100-continue\r\n\r\n')
+        stream.read_until(b'\r\n\r\n', self.stop)
+        self.assertTrue(self.wait().startswith(b'HTTP/1.1 100'))
+        return stream
+
+    def _post(self, chunks):
+        """POST 'chunks' to the proxy, returning the (status line, headers, body) of
+        its response, or None if the connection was closed or reset instead.
+        """
+        stream = self._connect()
+        for chunk in chunks:
+            stream.write(b'{0:x}\r\n{1}\r\n'.format(len(chunk), chunk))
+        stream.write(b'0\r\n\r\n')
+
+        stream.set_close_callback(lambda: self.stop(None))
+        stream.read_until(b'\r\n\r\n', self.stop)
+        head = self.wait()
+        if head is None:
+            return None
+        status_line, _, header_lines = head.partition(b'\r\n')
+        headers = dict(line.split(b': ', 1) for line in header_lines.split(b'\r\n') if line)
+        body = b''
+        if int(headers.get('Content-Length', 0)):
+            stream.read_bytes(int(headers['Content-Length']), self.stop)
+            body = self.wait()
+        stream.set_close_callback(None)
+        stream.close()
+        return status_line, headers, body
+
+    def test_relays_target_response_with_plaintext_etag(self):
+        self._store(b'HTTP/1.1 201 Created\r\nETag: {etag}\r\n'
+                    b'X-Trans-Id: tx1\r\nContent-Length: 0\r\n\r\n')
+        status_line, headers, body = self._post([b'abcdefghijklmnopqrstuvwxyz',
+                                                 b'1234567890abcdef'])
+
+        self.assertEqual(b'HTTP/1.1 201 Created', status_line)
+        self.assertEqual(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890ABCDEF', self.target_body)
+        self.assertEqual(hashlib.md5(b'abcdefghijklmnopqrstuvwxyz1234567890abcdef')
+                         .hexdigest(), headers['Etag'])
+        self.assertEqual(b'tx1', headers['X-Trans-Id'])
+
+    def test_relays_target_error(self):
+        self._store(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 4\r\n\r\nbusy')
+        status_line, headers, body = self._post([b'abc'])
+
+        self.assertEqual(b'HTTP/1.1 503 Service Unavailable', status_line)
+        self.assertEqual(b'busy', body)
+
+    def test_unknown_status_without_reason(self):
+        self._store(b'HTTP/1.1 499\r\nContent-Length: 0\r\n\r\n')
+        status_line, headers, body = self._post([b'abc'])
+
+        self.assertEqual(b'HTTP/1.1 499 Unknown', status_line)
+
+    def test_early_target_response_reaches_client(self):
+        # The target refuses before reading the body, which the proxy must still read
+        #   (and drop) so that closing doesn't reset the client's connection.
+        self.target.on_request = lambda stream: stream.write(
+            b'HTTP/1.1 413 Request Entity Too Large\r\nContent-Length: 0\r\n\r\n',
+            stream.close)
+        status_line, headers, body = self._post([b'a' * 65536] * 16)
+
+        self.assertEqual(b'HTTP/1.1 413 Request Entity Too Large', status_line)
+
+    def test_target_reset_is_bad_gateway(self):
+        def on_request(stream):
+            stream.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            stream.read_bytes(1024, lambda data: reset(stream))
+
+        def reset(stream):
+            stream.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                     struct.pack('ii', 1, 0))
+            stream.close()
+        self.target.on_request = on_request
+        status_line, headers, body = self._post([b'a' * 65536] * 16)
+
+        self.assertEqual(b'HTTP/1.1 502 Bad Gateway', status_line)
+
+    def test_unreachable_target_is_bad_gateway(self):
+        self.target.stop()
+        status_line, headers, body = self._post([b'abc'])
+
+        self.assertEqual(b'HTTP/1.1 502 Bad Gateway', status_line)
+
+    def test_client_disconnect_cancels_target_request(self):
+        def on_request(stream):
+            stream.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            stream.read_until_close(lambda data: self.stop('target closed'))
+        self.target.on_request = on_request
+
+        stream = self._connect()
+        stream.write(b'3\r\nabc\r\n', stream.close)
+        self.assertEqual('target closed', self.wait())
+
+
+if __name__ == '__main__':
+    unittest.main()
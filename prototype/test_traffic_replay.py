@@ -0,0 +1,126 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+
+def unused_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TrafficReplayTestCase(unittest.TestCase):
+    """Replay generated captures through a real proxy to fake_target.py, each run in
+    its own process, checking status, memory and backpressure behavior end to end.
+    """
+
+    def setUp(self):
+        self.processes = []
+        self.tmp_dir = tempfile.mkdtemp()
+        self.target_port = unused_port()
+        self.proxy_port = unused_port()
+
+    def tearDown(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        shutil.rmtree(self.tmp_dir)
+
+    def _start(self, script, port, *args):
+        """Start 'script', returning its process once it accepts connections on 'port'."""
+        process = subprocess.Popen([sys.executable, script, '-port={0}'.format(port)] +
+                                   list(args),
+                                   stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            self.assertEqual(None, process.poll(), "{0} exited early".format(script))
+            try:
+                socket.create_connection(('localhost', port), timeout=0.1).close()
+                return process
+            except socket.error:
+                time.sleep(0.01)
+        self.fail("{0} didn't start listening".format(script))
+
+    def _replay(self, object_size, target_args=(), replay_args=()):
+        """Run the proxy against a fake target started with 'target_args', and replay a
+        generated POST of 'object_size' bytes through it. Return replay's (exit code,
+        output).
+        """
+        self._start('fake_target.py', self.target_port, *target_args)
+        proxy = self._start('crypto_proxy.py', self.proxy_port,
+                            '-target_port={0}'.format(self.target_port))
+
+        capture = os.path.join(self.tmp_dir, 'capture.jsonl')
+        subprocess.check_call([sys.executable, 'traffic_replay.py', '-mode=generate',
+                               '-object_size={0}'.format(object_size),
+                               '-capture={0}'.format(capture)],
+                              stdout=open(os.devnull, 'w'))
+        replay = subprocess.Popen([sys.executable, 'traffic_replay.py', '-mode=replay',
+                                   '-speed=0', '-capture={0}'.format(capture),
+                                   '-proxy_port={0}'.format(self.proxy_port),
+                                   '-proxy_pid={0}'.format(proxy.pid)] + list(replay_args),
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = replay.communicate()[0]
+        return replay.returncode, output
+
+    def test_bandwidth_capped_target(self):
+        code, output = self._replay(2097152,
+                                    target_args=['-bandwidth=2000000', '-rcvbuf=65536'],
+                                    replay_args=['-expect_status=201',
+                                                 '-max_rss_kb=65536'])
+        self.assertEqual(0, code, output)
+        self.assertTrue('Response: HTTP/1.1 201' in output, output)
+
+    def test_slow_reader_target(self):
+        code, output = self._replay(1048576,
+                                    target_args=['-read_size=4096', '-read_delay=0.001',
+                                                 '-rcvbuf=65536'],
+                                    replay_args=['-expect_status=201',
+                                                 '-max_rss_kb=65536'])
+        self.assertEqual(0, code, output)
+
+    def test_target_reset_is_reported(self):
+        code, output = self._replay(2097152,
+                                    target_args=['-reset_after=100000'],
+                                    replay_args=['-expect_status=502'])
+        self.assertEqual(0, code, output)
+        self.assertTrue('Response: HTTP/1.1 502' in output, output)
+
+    def test_connection_reset_fails(self):
+        # Replay straight to a target that resets mid-request, without responding.
+        self._start('fake_target.py', self.target_port, '-reset_after=100000')
+        capture = os.path.join(self.tmp_dir, 'capture.jsonl')
+        subprocess.check_call([sys.executable, 'traffic_replay.py', '-mode=generate',
+                               '-object_size=2097152', '-capture={0}'.format(capture)],
+                              stdout=open(os.devnull, 'w'))
+        replay = subprocess.Popen([sys.executable, 'traffic_replay.py', '-mode=replay',
+                                   '-speed=0', '-capture={0}'.format(capture),
+                                   '-proxy_port={0}'.format(self.target_port)],
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = replay.communicate()[0]
+        self.assertEqual(1, replay.returncode, output)
+        self.assertTrue('Response: (none, connection closed)' in output, output)
+        self.assertTrue('FAIL: connection' in output, output)
+
+    def test_unexpected_status_fails(self):
+        code, output = self._replay(65536, target_args=['-status=503'])
+        self.assertEqual(1, code, output)
+        self.assertTrue('FAIL: status 503, expected 2xx' in output, output)
+
+    def test_memory_bound_fails(self):
+        code, output = self._replay(65536, replay_args=['-max_rss_kb=1'])
+        self.assertEqual(1, code, output)
+        self.assertTrue('FAIL: peak RSS' in output, output)
+
+
+if __name__ == '__main__':
+    unittest.main()
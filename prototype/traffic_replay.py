@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Records and replays client traffic to the crypto proxy, keeping the original
+#   write boundaries and timing, so a run can be reproduced exactly against the
+#   proxy and fake_target.py. Captures are files of one JSON record per client
+#   write: {"t": seconds since connect, "data": base64 bytes}.
+#
+#   Record, relaying a real client (e.g. curl to port 7000) through to the proxy:
+#     python traffic_replay.py -mode=record -port=7000 -proxy_port=8000 -capture=x.jsonl
+#   Generate a synthetic chunked POST of -object_size bytes:
+#     python traffic_replay.py -mode=generate -object_size=104857600 -capture=x.jsonl
+#   Replay, optionally -speed times faster, reporting the proxy's -proxy_pid peak RSS:
+#     python traffic_replay.py -mode=replay -proxy_port=8000 -capture=x.jsonl
+#
+#   As a regression check, replay exits non-zero if the response status isn't
+#   -expect_status (any 2xx by default), throughput is under -min_mbps, or the
+#   proxy's peak RSS is over -max_rss_kb, or the connection is closed or reset
+#   before the whole response arrives.
+
+import base64
+import json
+import socket
+import sys
+import time
+
+from tornado.options import define, options, parse_command_line
+
+
+define('mode', default='replay', help="record, replay or generate")
+define('capture', default='capture.jsonl')
+define('port', default=7000, help="port to record client traffic on")
+define('proxy_port', default=8000)
+define('speed', default=1.0, help="replay speed multiplier, 0 to send without delays")
+define('proxy_pid', default=0, help="report this process's peak RSS after replaying")
+define('expect_status', default=0, help="fail unless the response has this status "
+                                        "(0 for any 2xx)")
+define('min_mbps', default=0.0, help="fail if throughput is below this, in MB/s")
+define('max_rss_kb', default=0, help="fail if -proxy_pid's peak RSS is above this")
+define('object_size', default=1048576)
+define('chunk_size', default=65536)
+define('chunk_interval', default=0.0)
+
+
+def load_capture(path):
+    """Return the (offset seconds, data) records of a capture file."""
+    with open(path) as capture:
+        return [(record['t'], base64.b64decode(record['data']))
+                for record in (json.loads(line) for line in capture)]
+
+
+def save_capture(path, records):
+    with open(path, 'w') as capture:
+        for offset, data in records:
+            capture.write(json.dumps({'t': offset,
+                                      'data': base64.b64encode(data)}) + '\n')
+
+
+def peak_rss_kb(pid):
+    """Return the peak resident set size of process 'pid', in KB."""
+    with open('/proc/{0}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+
+
+def final_response(response):
+    """Return 'response' without any interim 1xx responses (such as 100 Continue)."""
+    while response.startswith(b'HTTP/1.1 1') and b'\r\n\r\n' in response:
+        response = response.split(b'\r\n\r\n', 1)[1]
+    return response
+
+
+def generate():
+    """Write a capture of one chunked POST, sent as evenly timed chunks."""
+    header = (b"POST /chunked HTTP/1.1\r\nHost: localhost:" + str(options.proxy_port) +
+              b"\r\nContent-Type: application/octet-stream\r\n" +
+              b"Transfer-Encoding: chunked\r\n" +
+              b"Expect: 100-continue\r\n\r\n")
+    records = [(0.0, header)]
+    offset = 0.0
+    remaining = options.object_size
+    while remaining:
+        size = min(options.chunk_size, remaining)
+        offset += options.chunk_interval
+        records.append((offset, b'{0:x}\r\n{1}\r\n'.format(size, b'a' * size)))
+        remaining -= size
+    records.append((offset, b'0\r\n\r\n'))
+    save_capture(options.capture, records)
+    print('Wrote {0} records to {1}'.format(len(records), options.capture))
+
+
+def record():
+    """Relay one client connection through to the proxy, capturing what it sends."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('localhost', options.port))
+    listener.listen(1)
+    print('Recording on port {0}...'.format(options.port))
+    client, _ = listener.accept()
+    proxy = socket.create_connection(('localhost', options.proxy_port))
+
+    # Relay client to proxy until the final chunk is seen, then relay the response back.
+    records = []
+    start = time.time()
+    sent = str()
+    while not sent.endswith(b'0\r\n\r\n'):
+        data = client.recv(65536)
+        if not data:
+            break
+        records.append((time.time() - start, data))
+        proxy.sendall(data)
+        sent = (sent + data)[-5:]
+        if b'100-continue' in data:
+            # Pass the proxy's interim 100 Continue along before reading the body.
+            client.sendall(proxy.recv(65536))
+    while True:
+        data = proxy.recv(65536)
+        if not data:
+            break
+        client.sendall(data)
+        if b'\r\n\r\n' in data and not data.startswith(b'HTTP/1.1 100'):
+            break
+
+    client.close()
+    proxy.close()
+    save_capture(options.capture, records)
+    print('Wrote {0} records to {1}'.format(len(records), options.capture))
+
+
+def replay():
+    """Send a capture to the proxy with its original write boundaries and timing."""
+    records = load_capture(options.capture)
+    total = sum(len(data) for _, data in records)
+
+    failures = []
+    proxy = socket.create_connection(('localhost', options.proxy_port))
+    start = time.time()
+    try:
+        for offset, data in records:
+            if options.speed:
+                delay = offset / options.speed - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            proxy.sendall(data)
+    except socket.error as e:
+        # The proxy may have responded (and closed) early, so still read what it sent.
+        failures.append('connection closed while sending: {0}'.format(e))
+    sent = time.time() - start
+
+    response = str()
+    try:
+        while b'\r\n\r\n' not in final_response(response):
+            data = proxy.recv(65536)
+            if not data:
+                failures.append('connection closed before the response was complete')
+                break
+            response += data
+    except socket.error as e:
+        failures.append('connection reset while reading the response: {0}'.format(e))
+    elapsed = time.time() - start
+    proxy.close()
+
+    status_line = final_response(response).split(b'\r\n', 1)[0]
+    mbps = total / (elapsed or 1e-9) / 1e6
+    print('Response: {0}'.format(status_line or '(none, connection closed)'))
+    print('Sent {0} bytes in {1} writes in {2:.3f}s, response after {3:.3f}s, '
+          '{4:.1f} MB/s'.format(total, len(records), sent, elapsed, mbps))
+
+    parts = status_line.split()
+    status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+    if options.expect_status:
+        if status != options.expect_status:
+            failures.append('status {0}, expected {1}'.format(status, options.expect_status))
+    elif status is None or not 200 <= status < 300:
+        failures.append('status {0}, expected 2xx'.format(status))
+    if options.min_mbps and mbps < options.min_mbps:
+        failures.append('{0:.1f} MB/s, expected at least {1}'.format(mbps, options.min_mbps))
+    if options.proxy_pid:
+        rss_kb = peak_rss_kb(options.proxy_pid)
+        print('Proxy peak RSS: {0} KB'.format(rss_kb))
+        if options.max_rss_kb and rss_kb > options.max_rss_kb:
+            failures.append('peak RSS {0} KB, expected at most {1}'.format(
+                rss_kb, options.max_rss_kb))
+    elif options.max_rss_kb:
+        failures.append('-max_rss_kb needs -proxy_pid')
+
+    for failure in failures:
+        print('FAIL: {0}'.format(failure))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parse_command_line()
+    {'record': record, 'replay': replay, 'generate': generate}[options.mode]()